@@ -1,16 +1,70 @@
 # Backup the Fakturama database.
+import atexit
 import os
+import re
 import subprocess
 import datetime as dt
 import argparse
-from typing import Optional
+from heapq import nlargest
+from operator import itemgetter
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import smtplib
 
 TEMPLATE_DATE_PLACEHOLDER_START = "[["
 TEMPLATE_DATE_PLACEHOLDER_END = "]]"
 
-type BackupInfo = tuple[dt.date, os.PathLike]
+SMTP_HOST = "smtp.uni-stuttgart.de"
+SMTP_PORT = 587
+
+# Email modules, only loaded when notifications are used. See `_load_smtp`.
+_smtp = None
+_ssl = None
+_EmailMessage = None
+
+type BackupInfo = tuple[dt.date, str]
+
+# Date format directives allowed in filename templates.
+DATE_FORMAT_DIRECTIVES = frozenset("aAbBdHIjmMpSUwWyY%")
+
+# Regex patterns for the date format directives `FilenameTemplate.match` can parse without `strptime`.
+# Fields are named after their directive so the date can be built directly from the match groups.
+# Time fields are bounded to hours 00-23, minutes 00-59 and seconds 00-59, matching what `datetime.strptime` accepts,
+# as their values are not checked otherwise.
+DATE_DIRECTIVE_PATTERNS = {
+    "Y": r"(?P<Y>\d{4})",
+    "m": r"(?P<m>\d{2})",
+    "d": r"(?P<d>\d{2})",
+    "H": r"(?P<H>[01]\d|2[0-3])",
+    "M": r"(?P<M>[0-5]\d)",
+    "S": r"(?P<S>[0-5]\d)",
+}
+
+def is_valid_date_format(date_format: str) -> bool:
+    """Check whether a date format only contains allowed directives.
+
+    Args:
+        date_format (str): Date format to check.
+
+    Returns:
+        bool: True if the format is not empty and every `%` is followed by a directive in `DATE_FORMAT_DIRECTIVES`.
+    """
+    if not date_format:
+        return False
+    
+    idx = date_format.find("%")
+    while idx != -1:
+        if date_format[idx + 1:idx + 2] not in DATE_FORMAT_DIRECTIVES:
+            return False
+        idx = date_format.find("%", idx + 2)
+    
+    return True
+
 
 class EmailCredentials:
+    __slots__ = ("email", "username", "password")
+    
     def __init__(self, email: str, username: str, password: str):
         """Create a new set of email credentials.
 
@@ -26,6 +80,8 @@ class EmailCredentials:
 class FilenameTemplate:
     """A template for backup files' names.
     """
+    __slots__ = ("_prefix", "_postfix", "_prefix_len", "_postfix_len", "_date_format", "_template", "_regex")
+    
     def __init__(self, template: str) -> None:
         """Create a new filename template.
 
@@ -42,14 +98,49 @@ class FilenameTemplate:
             raise ValueError(f"Date format must be in filename template, enclosed by `{TEMPLATE_DATE_PLACEHOLDER_START}` and `{TEMPLATE_DATE_PLACEHOLDER_END}`")
         
         date_format = template[idx_start + len(TEMPLATE_DATE_PLACEHOLDER_START):idx_end]
-        now = dt.date.today()
-        if not now.strftime(date_format):
+        if not is_valid_date_format(date_format):
             raise ValueError(f"Invalid date format `{date_format}`")
         
         self._prefix = template[:idx_start]
         self._postfix = template[idx_end + len(TEMPLATE_DATE_PLACEHOLDER_END):]
+        self._prefix_len = len(self._prefix)
+        self._postfix_len = len(self._postfix)
         self._date_format = date_format
         self._template = template
+        self._regex = self._compile_regex()
+        
+    def _compile_regex(self) -> Optional[re.Pattern]:
+        """Translate the template into a regular expression.
+
+        Returns:
+            Optional[re.Pattern]: Pattern matching filenames of the template.
+                None if the date format can not be translated, in which case `strptime` must be used.
+        """
+        pattern = []
+        directives = set()
+        idx = 0
+        while idx < len(self._date_format):
+            char = self._date_format[idx]
+            if char != "%":
+                pattern.append(re.escape(char))
+                idx += 1
+                continue
+            
+            directive = self._date_format[idx + 1:idx + 2]
+            if directive == "%":
+                pattern.append("%")
+            elif directive in DATE_DIRECTIVE_PATTERNS and directive not in directives:
+                pattern.append(DATE_DIRECTIVE_PATTERNS[directive])
+                directives.add(directive)
+            else:
+                return None
+            
+            idx += 2
+        
+        if not {"Y", "m", "d"} <= directives:
+            return None
+        
+        return re.compile(f"{re.escape(self._prefix)}{''.join(pattern)}{re.escape(self._postfix)}")
         
     @property
     def template(self) -> str:
@@ -111,12 +202,23 @@ class FilenameTemplate:
         Returns:
             Optional[dt.date]: Filename date according to the template. None if the filename does not match the template.
         """
+        if self._regex is not None:
+            match = self._regex.fullmatch(filename)
+            if match is None:
+                return None
+            try:
+                return dt.date(int(match["Y"]), int(match["m"]), int(match["d"]))
+            except ValueError:
+                return None
+        
         if not filename.startswith(self._prefix):
             return None
         if not filename.endswith(self._postfix):
             return None
         
-        filename_maybe_date = filename[len(self._prefix):-len(self._postfix)]
+        # An empty postfix must slice to the end, `-0` would yield an empty string.
+        end = -self._postfix_len if self._postfix_len else None
+        filename_maybe_date = filename[self._prefix_len:end]
         try:
             filename_date = dt.datetime.strptime(filename_maybe_date, self._date_format)
         except ValueError:
@@ -178,9 +280,87 @@ def parse_command_line_arguments() -> argparse.Namespace:
     if args.notify is not None and (args.notify_username is None or args.notify_password is None):
         parser.error("--notify requires --notify-username and --notify-password")
     
+    if args.notify is not None:
+        # Load now so a failed backup does not pay the import cost before notifying.
+        _load_smtp()
+    
     return args
     
     
+def _load_smtp() -> None:
+    """Import the modules required to send emails, if not already done.
+    """
+    global _smtp, _ssl, _EmailMessage
+    if _smtp is not None:
+        return
+    
+    import smtplib as _smtp
+    import ssl as _ssl
+    from email.message import EmailMessage as _EmailMessage
+    
+    
+class _SMTPPool:
+    """Keeps a single authenticated SMTP connection open for reuse between emails.
+    """
+    __slots__ = ("_conn", "_credentials")
+    
+    def __init__(self) -> None:
+        """Create a new pool without an open connection.
+        
+        A connection is only opened on the first call to `get`.
+        """
+        self._conn = None
+        self._credentials = None
+        
+    def get(self, credentials: EmailCredentials) -> "smtplib.SMTP":
+        """Get a connection logged in with `credentials`, reconnecting if the current one is unusable.
+
+        Args:
+            credentials (EmailCredentials): Email credentials to log in with.
+
+        Returns:
+            smtplib.SMTP: Authenticated SMTP connection.
+        """
+        if self._conn is not None and self._credentials is credentials:
+            try:
+                if self._conn.noop()[0] == 250:
+                    return self._conn
+            except OSError:
+                pass
+            
+        self.close()
+        server = _smtp.SMTP(SMTP_HOST, port=SMTP_PORT)
+        try:
+            ssl_context = _ssl.create_default_context()
+            server.starttls(context=ssl_context)
+            server.login(credentials.username, credentials.password)
+        except Exception:
+            server.close()
+            raise
+        
+        self._conn = server
+        self._credentials = credentials
+        return server
+    
+    def close(self) -> None:
+        """Close the pooled connection, if any.
+        """
+        if self._conn is None:
+            return
+        
+        try:
+            self._conn.quit()
+        except OSError:
+            self._conn.close()
+        finally:
+            self._conn = None
+            self._credentials = None
+            
+
+_smtp_pool = _SMTPPool()
+atexit.register(_smtp_pool.close)
+
+    
 def send_error_email(credentials: EmailCredentials, status: subprocess.CompletedProcess):
     """Send an email to the same address as `credentials` indicating an error ocurred while trying to backup the database.
 
@@ -188,17 +368,15 @@ def send_error_email(credentials: EmailCredentials, status: subprocess.Completed
         credentials (EmailCredentials): Email credentials to send the mail. The mail is sent to the same address.
         status (subprocess.CompletedProcess): Status of the backup process.
     """
-    msg = EmailMessage()
+    _load_smtp()
+    msg = _EmailMessage()
     msg['From'] = credentials.email
     msg['To'] = credentials.email
     msg['Subject'] = "Fakturama backup error"
     msg.set_content(f"The Fakturama backup script encountered an error, returning with code: {status.returncode}.")
     
-    with smtplib.SMTP("smtp.uni-stuttgart.de", port=587) as server:
-        ssl_context = ssl.create_default_context()
-        server.starttls(context=ssl_context)
-        server.login(credentials.username, credentials.password)
-        server.send_message(msg)
+    server = _smtp_pool.get(credentials)
+    server.send_message(msg)
 
     
 def create_backup(username: str, password: str, database: str, template: FilenameTemplate, directory: str | os.PathLike = ".", notify: Optional[EmailCredentials] = None):
@@ -229,19 +407,26 @@ def find_backups(template: FilenameTemplate, directory: str | os.PathLike = ".")
         directory (str | os.PathLike, optional): Directory to search in. Search is not recursive. Defaults to ".".
 
     Returns:
-        list[BackupInfo]: Tuples of (date, path) of matching files. `path` is the absolute path to the file.
+        list[BackupInfo]: Tuples of (date, name) of matching files. `name` is relative to `directory`.
     """
     backups = []
-    with os.scandir(directory) as it:
-        for entry in it:
-            if not entry.is_file():
-                continue
-            
-            date = template.match(entry.name)
-            if date is None:
-                continue
-            
-            backups.append((date, entry.path))
+    # Where supported, scan through a descriptor so entries do not build a joined `path` string.
+    dir_fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)) if os.scandir in os.supports_fd else None
+    try:
+        with os.scandir(directory if dir_fd is None else dir_fd) as it:
+            for entry in it:
+                # Match the name first so only candidates may require a `stat` call.
+                date = template.match(entry.name)
+                if date is None:
+                    continue
+                
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                
+                backups.append((date, entry.name))
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
         
     return backups
 
@@ -256,25 +441,27 @@ def filter_discard_backups(backups: list[BackupInfo], retain: int) -> list[Backu
     Returns:
         list[BackupInfo]: Backups to discard.
     """
-    backups = sorted(backups, key=lambda backup: backup[0], reverse=True)
-    return backups[retain:]
+    if len(backups) <= retain:
+        return []
+    
+    keep = set(map(id, nlargest(retain, backups, key=itemgetter(0))))
+    return [backup for backup in backups if id(backup) not in keep]
 
 if __name__ == "__main__":
     args = parse_command_line_arguments()
     
     notify = None
     if args.notify is not None:
-        import smtplib
-        import ssl
-        from email.message import EmailMessage
         notify = EmailCredentials(args.notify, args.notify_username, args.notify_password)    
     
     create_backup(args.username, args.password, args.database, args.file, args.dir, notify)
     backups = find_backups(args.file, args.dir)
     discard = filter_discard_backups(backups, args.retain)
-    for (_, path) in discard:
+    # Delete by name from within the directory so each path resolves a single component.
+    os.chdir(args.dir)
+    for (_, name) in discard:
         try:
-            os.remove(path)
-        except Exception:
+            os.unlink(name)
+        except FileNotFoundError:
             pass
     
\ No newline at end of file